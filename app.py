@@ -1,20 +1,77 @@
 import os
+import asyncio
 import logging
+import atexit
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import functools
+import gzip
+import hashlib
+import brotli
 import uvicorn
-import tempfile
-import ffmpeg
-import whisper # <-- Import the whisper library
-from datetime import timedelta
-from fastapi import FastAPI, File, UploadFile, HTTPException
-from fastapi.responses import HTMLResponse, FileResponse, PlainTextResponse
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import av
+import numpy as np
+import ctranslate2
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from dotenv import load_dotenv
 
 # --- Basic Configuration ---
 load_dotenv()
-logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
-app = FastAPI()
+# Request handlers only enqueue already-formatted records; a background thread does the actual writing
+log_queue = queue.SimpleQueue()
+log_listener = QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s', handlers=[QueueHandler(log_queue)])
+
+# Sets up per-process resources when a serving process starts and releases them when it stops.
+# Everything is created here rather than at import so a second lifespan in the same process starts clean;
+# the helpers and globals live in the cache and model configuration sections below.
+@asynccontextmanager
+async def lifespan(app):
+    global redis_client
+    if REDIS_URL:
+        redis_client = redis.from_url(REDIS_URL)
+    load_whisper_model()
+    yield
+    whisper_pool.shutdown()
+    if redis_client is not None:
+        await redis_client.aclose()
+        redis_client = None
+
+app = FastAPI(lifespan=lifespan)
+
+# --- Upload Configuration ---
+UPLOAD_CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_BYTES", 500 * 1024 * 1024))
+UPLOAD_TOO_LARGE_DETAIL = f"File too large. The limit is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB."
+
+# FastAPI reads and spools the whole multipart body before the endpoint runs, so an honest
+# Content-Length over the limit has to be turned away here, before any of the body is read.
+# Plain ASGI rather than @app.middleware so other routes don't pay BaseHTTPMiddleware's per-request overhead.
+class RejectOversizeUploads:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'http' and scope['method'] == 'POST' and scope['path'] == '/api/process_local':
+            content_length = dict(scope['headers']).get(b'content-length', b'')
+            if content_length.isdigit() and int(content_length) > MAX_UPLOAD_BYTES:
+                response = JSONResponse(status_code=413, content={"detail": UPLOAD_TOO_LARGE_DETAIL})
+                await response(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+# Added before CORS so the CORS middleware wraps it and a 413 still reaches the browser's fetch
+app.add_middleware(RejectOversizeUploads)
 
 # --- CORS Middleware ---
 app.add_middleware(
@@ -25,16 +82,123 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# --- Transcript Cache ---
+# Re-uploads of the same file (retries, other browsers) are answered from here without re-transcribing.
+# With REDIS_URL set the cache is shared by all workers; otherwise each process keeps its own LRU.
+SRT_CACHE_SIZE = int(os.environ.get("SRT_CACHE_SIZE", 256))
+SRT_CACHE_TTL = int(os.environ.get("SRT_CACHE_TTL", 7 * 24 * 3600))
+REDIS_URL = os.environ.get("REDIS_URL")
+srt_cache = OrderedDict()
+cache_hits = 0
+
+redis_client = None
+if REDIS_URL:
+    import redis.asyncio as redis # Optional dependency, only needed when REDIS_URL is set; the client is opened in lifespan
+
+def srt_cache_key(digest):
+    # Redis entries outlive deployments, so the key names everything that shapes the output;
+    # bump the version whenever the transcription pipeline itself changes
+    return f"srt:v3:faster-whisper:{MODEL_SIZE}:{COMPUTE_TYPE}:{digest}"
+
+async def get_cached_srt(key):
+    global cache_hits
+    if redis_client is not None:
+        try:
+            srt = await redis_client.get(key)
+        except Exception as e:
+            logging.warning("Redis cache lookup failed: %s", e)
+            return None
+        srt = srt.decode() if srt is not None else None
+    else:
+        srt = srt_cache.get(key)
+        if srt is not None:
+            srt_cache.move_to_end(key)
+    if srt is not None:
+        cache_hits += 1
+    return srt
+
+async def cache_srt(key, srt):
+    if redis_client is not None:
+        try:
+            await redis_client.set(key, srt, ex=SRT_CACHE_TTL)
+        except Exception as e:
+            logging.warning("Redis cache store failed: %s", e)
+        return
+    srt_cache[key] = srt
+    srt_cache.move_to_end(key)
+    while len(srt_cache) > SRT_CACHE_SIZE:
+        srt_cache.popitem(last=False)
+
+# --- Audio Decoding ---
+WHISPER_SAMPLE_RATE = 16000
+
+def decode_audio(source):
+    # Decode once, in-process, straight to the 16 kHz mono float32 samples Whisper consumes.
+    # source can be a path or a seekable file object such as the upload's spooled file. mode='r' is explicit
+    # because av.open otherwise follows the file object's mode, and small in-memory uploads are 'w+b'.
+    resampler = av.AudioResampler(format='flt', layout='mono', rate=WHISPER_SAMPLE_RATE)
+    samples = []
+    with av.open(source, mode='r') as container:
+        if not container.streams.audio:
+            raise ValueError("The uploaded file contains no audio stream.")
+        stream = container.streams.audio[0]
+        # Let the decoder use frame/slice threads where the codec supports them; video streams are never decoded
+        stream.thread_type = 'AUTO'
+        for frame in container.decode(stream):
+            samples.extend(resampled.to_ndarray().reshape(-1) for resampled in resampler.resample(frame))
+        samples.extend(resampled.to_ndarray().reshape(-1) for resampled in resampler.resample(None))
+    if not samples:
+        return np.zeros(0, dtype=np.float32)
+    return np.concatenate(samples)
+
 # --- LOCAL WHISPER MODEL CONFIGURATION ---
-try:
-    MODEL_SIZE = os.environ.get("MODEL_SIZE", "base")
-    logging.info(f"--- Loading local Whisper model: {MODEL_SIZE} ---")
-    # This line downloads the model to a cache directory on first run
-    model = whisper.load_model(MODEL_SIZE)
-    logging.info("--- Whisper model loaded successfully. ---")
-except Exception as e:
-    logging.error(f"Failed to load Whisper model: {e}")
-    model = None
+# Use the GPU when one is available; WHISPER_DEVICE forces a choice. CTranslate2 runs int8 on CPU and float16 on CUDA.
+DEVICE = os.environ.get("WHISPER_DEVICE") or ("cuda" if ctranslate2.get_cuda_device_count() > 0 else "cpu")
+COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE") or ("float16" if DEVICE == "cuda" else "int8")
+WHISPER_BATCH_SIZE = int(os.environ.get("WHISPER_BATCH_SIZE", 8))
+MODEL_SIZE = os.environ.get("MODEL_SIZE", "base")
+model = None
+
+# Transcriptions get their own threads so they never starve the shared threadpool used for decoding and
+# file I/O, and a semaphore so extra requests wait their turn instead of oversubscribing the GPU/CPU.
+# Both are per worker process: every worker loads its own model, so the host-wide limit is this times WORKERS
+# (which is why WORKERS defaults to 1 on CUDA).
+MAX_CONCURRENT_TRANSCRIBES = int(os.environ.get("MAX_CONCURRENT_TRANSCRIBES", 1 if DEVICE == "cuda" else 2))
+whisper_pool, transcribe_slots = None, None
+
+# Called from lifespan rather than at import, so only the serving processes hold a copy and not the
+# `python app.py` launcher that spawns the workers
+def load_whisper_model():
+    global model, whisper_pool, transcribe_slots
+    # Created per lifespan: the semaphore belongs to the server's event loop, and the pool is shut down on exit
+    whisper_pool = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_TRANSCRIBES, thread_name_prefix="whisper")
+    transcribe_slots = asyncio.Semaphore(MAX_CONCURRENT_TRANSCRIBES)
+    try:
+        logging.info("--- Loading local Whisper model: %s on %s (%s) ---", MODEL_SIZE, DEVICE, COMPUTE_TYPE)
+        # This line downloads the model to a cache directory on first run
+        # num_workers lets CTranslate2 actually run that many transcriptions in parallel
+        model = WhisperModel(MODEL_SIZE, device=DEVICE, compute_type=COMPUTE_TYPE, num_workers=MAX_CONCURRENT_TRANSCRIBES)
+        logging.info("--- Whisper model loaded successfully. ---")
+    except Exception as e:
+        logging.error("Failed to load Whisper model: %s", e)
+        model = None
+
+def transcribe_audio(audio):
+    # The batched pipeline splits the file into VAD chunks and runs them through the model in batches. It keeps
+    # per-transcription state (last_speech_timestamp) on the instance, so each call gets its own; the constructor
+    # only stores the shared model reference.
+    # faster-whisper decodes lazily while the segments are iterated, so consume them here in the worker thread.
+    pipeline = BatchedInferencePipeline(model=model)
+    segments, _ = pipeline.transcribe(audio, batch_size=WHISPER_BATCH_SIZE, word_timestamps=True, vad_filter=True)
+    segments = list(segments)
+    # Same shape as openai-whisper's result dict, which the endpoint below expects
+    return {
+        'text': ''.join(segment.text for segment in segments),
+        'segments': [
+            {'words': [{'word': word.word, 'start': word.start, 'end': word.end} for word in segment.words or []]}
+            for segment in segments
+        ],
+    }
 
 
 # --- Word Grouping Function for Perfect Subtitles ---
@@ -42,46 +206,51 @@ except Exception as e:
 def group_words_into_sentences(word_chunks, max_chars=42, pause_threshold=0.7):
     if not word_chunks:
         return []
-    sentence_chunks, current_sentence = [], []
+    sentence_chunks, current_sentence, current_len = [], [], -1
+    last_index = len(word_chunks) - 1
     for i, word_chunk in enumerate(word_chunks):
         current_sentence.append(word_chunk)
-        current_text = ' '.join(w['text'] for w in current_sentence) # Changed from w['text'].strip()
+        # Track the joined length incrementally (+1 for the space) instead of re-joining the sentence per word
+        current_len += len(word_chunk['text']) + 1
         is_punctuation_end = word_chunk['text'].strip().endswith(('.', '?', '!'))
-        is_max_len_reached = len(current_text) >= max_chars
         is_pause_after = False
-        if i < len(word_chunks) - 1:
+        if i < last_index:
             next_word_start = word_chunks[i+1]['timestamp'][0]
             current_word_end = word_chunk['timestamp'][1]
             if current_word_end is not None and next_word_start is not None and (next_word_start - current_word_end > pause_threshold):
                 is_pause_after = True
-        is_last_word = (i == len(word_chunks) - 1)
-        if is_last_word or is_punctuation_end or is_pause_after or is_max_len_reached:
-            if not current_sentence: continue
+        if i == last_index or is_punctuation_end or is_pause_after or current_len >= max_chars:
+            current_text = ' '.join(w['text'] for w in current_sentence) # Changed from w['text'].strip()
             start_ts = current_sentence[0]['timestamp'][0]
             end_ts = current_sentence[-1]['timestamp'][1]
             sentence_chunks.append({'text': current_text, 'timestamp': [start_ts, end_ts]})
-            current_sentence = []
-    logging.info(f"Grouped {len(word_chunks)} words into {len(sentence_chunks)} sentences.")
+            current_sentence, current_len = [], -1
+    logging.info("Grouped %d words into %d sentences.", len(word_chunks), len(sentence_chunks))
     return sentence_chunks
 
-# --- SRT Formatting Helper Function (Unchanged) ---
+# --- SRT Formatting Helper Function ---
+# %-formatting beats an f-string with four padded format specs; plain entries stay f-strings
+SRT_TIME_TEMPLATE = "%02d:%02d:%02d,%03d"
+
+@functools.lru_cache(maxsize=4096)
+def format_srt_time(seconds_float):
+    # Memoized: silence gaps and repeated boundaries produce the same timestamps many times over
+    if seconds_float is None or seconds_float < 0: seconds_float = 0.0
+    # Integer math on milliseconds; rounding to microseconds first matches timedelta's behaviour
+    milliseconds = round(seconds_float * 1000000) // 1000
+    hours, milliseconds = divmod(milliseconds, 3600000)
+    minutes, milliseconds = divmod(milliseconds, 60000)
+    seconds, milliseconds = divmod(milliseconds, 1000)
+    return SRT_TIME_TEMPLATE % (hours, minutes, seconds, milliseconds)
+
 def format_to_srt(chunks):
-    def format_srt_time(seconds_float):
-        if seconds_float is None or seconds_float < 0: seconds_float = 0.0
-        delta = timedelta(seconds=seconds_float)
-        hours, remainder = divmod(int(delta.total_seconds()), 3600)
-        minutes, seconds = divmod(remainder, 60)
-        milliseconds = delta.microseconds // 1000
-        return f"{hours:02d}:{minutes:02d}:{seconds:02d},{milliseconds:03d}"
-    srt_content = []
     if not chunks: return ""
-    for i, chunk in enumerate(chunks):
-        start_time_val = chunk.get('timestamp', [0, 0])[0]
-        end_time_val = chunk.get('timestamp', [0, 0.5])[1] or (start_time_val + 0.5)
+    srt_content = []
+    for i, chunk in enumerate(chunks, 1):
+        start_time_val, end_time_val = chunk.get('timestamp', (0, 0.5))
+        end_time_val = end_time_val or (start_time_val + 0.5)
         text = chunk.get('text', '').strip()
-        start_time = format_srt_time(start_time_val)
-        end_time = format_srt_time(end_time_val)
-        srt_content.append(f"{i + 1}\n{start_time} --> {end_time}\n{text}\n")
+        srt_content.append(f"{i}\n{format_srt_time(start_time_val)} --> {format_srt_time(end_time_val)}\n{text}\n")
     return "\n".join(srt_content)
 
 
@@ -91,26 +260,37 @@ async def process_audio_locally(file: UploadFile = File(...)):
     if not model:
         raise HTTPException(status_code=500, detail="Whisper model is not loaded. Check server logs.")
 
-    logging.info(f"--- API call received for file: {file.filename} ---")
-    input_temp_path, output_temp_path = None, None
+    logging.info("--- API call received for file: %s ---", file.filename)
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=f"_{file.filename}") as temp_file:
-            content = await file.read()
-            temp_file.write(content)
-            input_temp_path = temp_file.name
-
-        base_name, _ = os.path.splitext(input_temp_path)
-        output_temp_path = f"{base_name}_processed.mp3"
-        logging.info(f"Extracting audio from '{input_temp_path}' to '{output_temp_path}'")
+        # Starlette has already spooled the upload to a temp file, so hash and size-check it in place
+        # instead of copying it somewhere else; file.size is not always known, so count the bytes read too
+        upload_size, upload_hash = 0, hashlib.blake2b(digest_size=16)
+        while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+            upload_size += len(chunk)
+            if upload_size > MAX_UPLOAD_BYTES:
+                raise HTTPException(status_code=413, detail=UPLOAD_TOO_LARGE_DETAIL)
+            upload_hash.update(chunk)
+
+        cache_key = srt_cache_key(upload_hash.hexdigest())
+        cached_srt = await get_cached_srt(cache_key)
+        if cached_srt is not None:
+            logging.info("Returning cached subtitles for '%s' (%d cache hits so far).", file.filename, cache_hits)
+            return PlainTextResponse(content=cached_srt, media_type="text/plain")
+
+        logging.info("Decoding audio from '%s'", file.filename)
+        await file.seek(0)
         try:
-            ffmpeg.input(input_temp_path).output(output_temp_path, acodec='libmp3lame', audio_bitrate='192k', **{'map_metadata': -1}).run(overwrite_output=True, capture_stdout=True, capture_stderr=True)
-        except ffmpeg.Error as e:
-            error_details = e.stderr.decode() if e.stderr else "Unknown FFmpeg error"
-            raise HTTPException(status_code=500, detail=f"Failed to process media file. FFmpeg error: {error_details}")
+            # Decoding and Whisper are blocking; run them off the event loop so other uploads keep flowing
+            audio = await run_in_threadpool(decode_audio, file.file)
+        except (av.error.FFmpegError, ValueError) as e:
+            raise HTTPException(status_code=500, detail=f"Failed to process media file. Decoding error: {e}")
 
         # --- THIS IS THE CORE CHANGE: USE LOCAL MODEL ---
-        logging.info(f"Transcribing '{output_temp_path}' with local Whisper model...")
-        result = model.transcribe(output_temp_path, word_timestamps=True, fp16=False) # fp16=False for CPU
+        logging.info("Transcribing %.1f seconds of audio with local Whisper model...", len(audio) / WHISPER_SAMPLE_RATE)
+        async with transcribe_slots:
+            result = await asyncio.get_running_loop().run_in_executor(whisper_pool, transcribe_audio, audio)
         
         # --- Adapt local whisper output to the format our grouping function expects ---
         all_words = []
@@ -121,7 +301,7 @@ async def process_audio_locally(file: UploadFile = File(...)):
              logging.warning("Whisper did not return any words. Returning full text as one chunk.")
              full_text = result.get('text', '').strip()
              if not full_text: return PlainTextResponse(content="", media_type="text/plain")
-             duration = float(ffmpeg.probe(output_temp_path)['format']['duration'])
+             duration = len(audio) / WHISPER_SAMPLE_RATE
              word_chunks_for_grouping = [{'text': full_text, 'timestamp': [0, duration]}]
         else:
             word_chunks_for_grouping = [
@@ -129,27 +309,92 @@ async def process_audio_locally(file: UploadFile = File(...)):
                 for word in all_words
             ]
 
-        sentence_chunks = group_words_into_sentences(word_chunks_for_grouping)
-        srt_output = format_to_srt(sentence_chunks)
+        # Grouping and SRT formatting are pure CPU work; keep them off the event loop for long transcripts
+        sentence_chunks = await run_in_threadpool(group_words_into_sentences, word_chunks_for_grouping)
+        srt_output = await run_in_threadpool(format_to_srt, sentence_chunks)
+        await cache_srt(cache_key, srt_output)
         return PlainTextResponse(content=srt_output, media_type="text/plain")
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logging.error(f"An internal error occurred: {e}", exc_info=True)
+        logging.error("An internal error occurred: %s", e, exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        if input_temp_path and os.path.exists(input_temp_path): os.remove(input_temp_path)
-        if output_temp_path and os.path.exists(output_temp_path): os.remove(output_temp_path)
 
-# --- Static File Serving (Unchanged) ---
-app.mount("/static", StaticFiles(directory="static"), name="static")
+# --- Precompressed Static Assets ---
+# The page, stylesheet and script never change at runtime, so compress and hash them once at import
+def load_static_asset(path, media_type, cache_control):
+    with open(path, 'rb') as f:
+        raw = f.read()
+    digest = hashlib.md5(raw).hexdigest()
+    # Each encoding is a separate representation, so each gets its own strong ETag (RFC 9110 8.8.3).
+    # Header dicts are built once too; Response only reads them.
+    variants = {}
+    for encoding, body in (('br', brotli.compress(raw, quality=11)), ('gzip', gzip.compress(raw, 9)), ('identity', raw)):
+        etag = f'"{digest}"' if encoding == 'identity' else f'"{digest}-{encoding}"'
+        headers = {'ETag': etag, 'Cache-Control': cache_control, 'Vary': 'Accept-Encoding'}
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        variants[encoding] = {'body': body, 'etag': etag, 'headers': headers}
+    return {'media_type': media_type, 'variants': variants}
+
+def negotiate_encoding(accept_encoding):
+    # Parse "coding;q=value" tokens so e.g. "br;q=0, gzip" really excludes Brotli; br wins ties with gzip
+    qualities = {}
+    for item in accept_encoding.split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+    best, best_quality = 'identity', 0.0
+    for coding in ('br', 'gzip'):
+        quality = qualities.get(coding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best, best_quality = coding, quality
+    return best
+
+def serve_static_asset(request, asset):
+    variant = asset['variants'][negotiate_encoding(request.headers.get('accept-encoding', ''))]
+    # If-None-Match uses weak comparison, so a W/ prefix from an intermediary still matches
+    if_none_match = [tag.strip() for tag in request.headers.get('if-none-match', '').split(',')]
+    if_none_match = [tag[2:] if tag.startswith('W/') else tag for tag in if_none_match]
+    if variant['etag'] in if_none_match or '*' in if_none_match:
+        return Response(status_code=304, headers=variant['headers'])
+    return Response(content=variant['body'], media_type=asset['media_type'], headers=variant['headers'])
+
+# index.html is revalidated on every load (a cheap 304) so a redeploy is picked up immediately
+INDEX_ASSET = load_static_asset('templates/index.html', 'text/html; charset=utf-8', 'no-cache')
+CSS_ASSET = load_static_asset('static/css/style.css', 'text/css; charset=utf-8', 'public, max-age=86400')
+JS_ASSET = load_static_asset('static/js/script.js', 'text/javascript; charset=utf-8', 'public, max-age=86400')
 
 @app.get("/", response_class=HTMLResponse)
-async def read_index():
-    return FileResponse('templates/index.html')
+async def read_index(request: Request):
+    return serve_static_asset(request, INDEX_ASSET)
+
+@app.get("/static/css/style.css")
+async def read_css(request: Request):
+    return serve_static_asset(request, CSS_ASSET)
+
+@app.get("/static/js/script.js")
+async def read_js(request: Request):
+    return serve_static_asset(request, JS_ASSET)
+
+# --- Static File Serving (any other files under static/) ---
+app.mount("/static", StaticFiles(directory="static"), name="static")
 
-# --- Main entry point for local execution (Unchanged) ---
+# --- Main entry point for local execution ---
 if __name__ == "__main__":
     print("--- Starting local development server ---")
     print("Access the application at http://127.0.0.1:8000")
     print("NOTE: The first time you run this, it will download the Whisper model, which may take some time.")
-    uvicorn.run(app, host="127.0.0.1", port=8000)
+    # uvicorn picks uvloop/httptools automatically where installed (uvicorn[standard]); the workers need an import string
+    # Each worker holds its own model copy, so on a GPU one worker keeps VRAM use and GPU concurrency bounded
+    default_workers = 1 if DEVICE == "cuda" else max(2, (os.cpu_count() or 2) // 2)
+    workers = int(os.environ.get("WORKERS", default_workers))
+    uvicorn.run("app:app", host="127.0.0.1", port=8000, workers=workers)